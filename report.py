@@ -4,40 +4,34 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-from collections import defaultdict
+from collections import Counter, defaultdict
 from dataclasses import dataclass
+from datetime import date
 from pprint import pprint
 import argparse
+import asyncio
+import calendar
+import csv
+import hashlib
 import os
 import sys
+import time
 
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
+import aiohttp
 import arrow
+import orjson
 
 
-TOTAL_SPONSORSHIP_AMOUNT_QUERY = gql("""
-query getTotalSponsorshipAmount($target: String!, $until: DateTime) {
-    repositoryOwner(login: $target) {
-        ... on Sponsorable {
-            totalSponsorshipAmountAsSponsorInCents(until: $until)
-        }
-    }
-}
-""")
-
 SPONSORSHIP_LOG_QUERY = gql("""
 query getSponsorshipLog($target: String!, $after: String, $since: DateTime) {
     repositoryOwner(login: $target) {
         ... on Sponsorable {
-            sponsorsActivities(first: 100, after: $after, since: $since, period: ALL, includeAsSponsor: true) {
+            sponsorsActivities(first: 100, after: $after, since: $since, period: ALL, includeAsSponsor: true,
+                    actions: [NEW_SPONSORSHIP, CANCELLED_SPONSORSHIP, TIER_CHANGE, REFUND]) {
                 nodes {
                     action
-                    paymentSource
-                    previousSponsorsTier {
-                        monthlyPriceInCents
-                        isOneTime
-                    }
                     sponsorsTier {
                         monthlyPriceInCents
                         isOneTime
@@ -63,7 +57,11 @@ query getSponsorshipLog($target: String!, $after: String, $since: DateTime) {
 """)
 
 
-@dataclass
+# Where we keep GraphQL responses between runs.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'osp-github-reporter')
+
+
+@dataclass(slots=True, frozen=True)
 class Payment:
     date: str
     login: str
@@ -78,82 +76,244 @@ def eprint(*args, **kwargs):
 
 
 """
-Gets a `gql.Client`.
+An `aiohttp.ClientResponse` that decodes JSON with `orjson`, which is a lot
+faster than the standard library for the large pages of events GitHub sends
+back.
+"""
+class ORJSONClientResponse(aiohttp.ClientResponse):
+    async def json(self, *, loads=orjson.loads, **kwargs):
+        return await super().json(loads=loads, **kwargs)
+
+
+"""
+Gets a `gql.Client`. This needs to be called from within a running event loop,
+and the client should be entered once with `async with client as session` and
+that session used for all queries, so that we keep reusing the same connections
+to GitHub instead of doing a new TLS handshake for each query.
 """
 def get_gql_client(token):
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10,
+        keepalive_timeout=75)
     transport = AIOHTTPTransport(url="https://api.github.com/graphql",
-        headers={'Authorization': f'bearer {token}'})
-    return Client(transport=transport, fetch_schema_from_transport=True)
+        headers={'Authorization': f'bearer {token}'},
+        client_session_args={
+            'connector': connector,
+            'response_class': ORJSONClientResponse,
+        })
+    return Client(transport=transport, fetch_schema_from_transport=False)
+
+
+"""
+Gets the path in the on-disk cache for the value identified by `key_parts`.
+"""
+def get_cache_path(*key_parts):
+    key = hashlib.blake2b(digest_size=16)
+    for key_part in key_parts:
+        key.update(key_part.encode())
+        key.update(b'\0')
+    return os.path.join(CACHE_DIR, f'{key.hexdigest()}.json')
 
 
 """
-Gets the total sponsorship amount in US cents that `target` has donated,
-`since` a given datetime.
+Loads a value from the on-disk cache, if we saved one there less than `ttl`
+seconds ago, and otherwise returns `None`. A `ttl` of `None` means the cached
+value never expires, which is what we want for data about the past, since it
+can't change.
 """
-def get_total_sponsorship_amount(client, target, until):
-    eprint(f"get_total_sponsorship_amount(_, {target}, {until})")
-    result = client.execute(TOTAL_SPONSORSHIP_AMOUNT_QUERY,
-        variable_values={'target': target, 'until': until})
-    return result['repositoryOwner']['totalSponsorshipAmountAsSponsorInCents']
+def load_cached(cache_path, ttl):
+    try:
+        age = time.time() - os.path.getmtime(cache_path)
+        if ttl is None or age < ttl:
+            with open(cache_path, 'rb') as f:
+                return orjson.loads(f.read())
+    except (OSError, ValueError):
+        pass
+    return None
 
 
 """
-Gets the total sponsorship amount in US cents that `target` has donated,
-from a given `start_date` to a given `end_date`, grouped by month.
+Saves a value to the on-disk cache.
 """
-def get_monthly_sponsorship_amounts(client, target, start_date, end_date):
-    # NOTE: GitHub supports a `since` field and an `until` field for total
-    # amounts, but not both at the same time! So we need to only use `until`
-    # and do some subtraction for each period using a running total.
-    eprint(f"get_total_sponsorship_amounts_for_date_range(_, {target}, {start_date}, {end_date})")
-    month_totals = []
-    month_start_date = start_date
-    month_end_date = month_start_date.shift(months=+1)
-    total_so_far = get_total_sponsorship_amount(client, target,
-        month_start_date.isoformat())
-    while month_start_date < end_date:
-        total_to_month_end = get_total_sponsorship_amount(client, target,
-            month_end_date.isoformat())
-        month_total = total_to_month_end - total_so_far
-        total_so_far = total_to_month_end
-        month_totals.append((month_start_date, month_total))
-        month_start_date = month_start_date.shift(months=+1)
-        month_end_date = month_start_date.shift(months=+1)
-    return month_totals
+def save_cached(cache_path, value):
+    # We write to a temporary file first so that an interrupted run can't
+    # leave a truncated value in the cache.
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(value))
+    os.replace(tmp_path, cache_path)
+
+
+"""
+Executes `query` with `variables` on `session`, reusing a response from the
+on-disk cache if we got one less than `ttl` seconds ago.
+"""
+async def cached_execute(session, query, variables, ttl):
+    cache_path = get_cache_path(query.loc.source.body,
+        orjson.dumps(variables, option=orjson.OPT_SORT_KEYS).decode())
+    result = load_cached(cache_path, ttl)
+    if result is None:
+        result = await session.execute(query, variable_values=variables)
+        save_cached(cache_path, result)
+    return result
 
 
 """
 Gets a log of all sponsorship events by the user or organization with login
-`target`.
+`target`. We only ask for the kinds of events that `reconstruct_payments()`
+actually uses. If we already have the events up to `stop_timestamp`, we stop
+once we get past it, and leave out anything older.
 """
-def get_sponsorship_log(client, target, start_date):
+async def get_sponsorship_log(session, target, start_date, cache_ttl,
+        stop_timestamp=None):
     eprint(f"get_sponsorship_log(_, {target}, {start_date})")
     events = []
 
-    after = None
-    while True:
-        page_results = client.execute(SPONSORSHIP_LOG_QUERY,
-            variable_values={'target': target, 'after': after, 'since': start_date.isoformat()})
-        events.extend(page_results['repositoryOwner']['sponsorsActivities']['nodes'])
-        after = page_results['repositoryOwner']['sponsorsActivities']['pageInfo']['endCursor']
-        if not page_results['repositoryOwner']['sponsorsActivities']['pageInfo']['hasNextPage']:
+    def fetch_page(after):
+        # Each page is cached separately, so that a run that gets interrupted
+        # halfway through doesn't need to fetch the earlier pages again.
+        return asyncio.create_task(cached_execute(session, SPONSORSHIP_LOG_QUERY,
+            {'target': target, 'after': after, 'since': start_date.isoformat()},
+            cache_ttl))
+
+    # NOTE: Each page's cursor comes from the previous page, so we can't fetch
+    # pages in parallel. What we can do is kick off the request for the next
+    # page as soon as we know its cursor, and only then process the current
+    # page, so that the two overlap.
+    next_page = fetch_page(None)
+    while next_page is not None:
+        page_results = await next_page
+        activities = page_results['repositoryOwner']['sponsorsActivities']
+        nodes = activities['nodes']
+        # NOTE: GitHub returns the newest events first, so once we see an event
+        # older than `stop_timestamp`, the rest are ones we already have too.
+        # Events at exactly `stop_timestamp` might carry on into the next page,
+        # and we might not have all of them, so those don't stop us, and we
+        # keep them; the caller skips the ones it already has.
+        if stop_timestamp is not None and any(node['timestamp'] < stop_timestamp for node in nodes):
+            events.extend(node for node in nodes if node['timestamp'] >= stop_timestamp)
             break
+        if activities['pageInfo']['hasNextPage']:
+            next_page = fetch_page(activities['pageInfo']['endCursor'])
+        else:
+            next_page = None
+        events.extend(nodes)
+
+    return events
+
+
+"""
+Gets a log of all sponsorship events by the user or organization with login
+`target`, like `get_sponsorship_log()`, but only asks GitHub for the events
+that happened since the last time we ran. We keep the events we've already
+seen in `CACHE_DIR`, along with the timestamp of the newest one.
+"""
+async def get_updated_sponsorship_log(session, target, start_date, cache_ttl):
+    events_path = os.path.join(CACHE_DIR, f'{target}.events.jsonl')
+    last_timestamp_path = os.path.join(CACHE_DIR, f'{target}.last_ts')
+
+    last_timestamp = load_cached(last_timestamp_path, None)
+    events = []
+    if last_timestamp is not None:
+        try:
+            with open(events_path, 'rb') as f:
+                events = [orjson.loads(line) for line in f]
+        except (OSError, ValueError):
+            last_timestamp = None
+            events = []
+
+    since = start_date if last_timestamp is None else arrow.get(last_timestamp)
+    new_events = await get_sponsorship_log(session, target, since, cache_ttl,
+        last_timestamp)
+
+    if last_timestamp is not None:
+        # NOTE: `since` includes events that happened at exactly
+        # `last_timestamp`, and if we got interrupted last time, we might have
+        # stored events that are newer than it, so we need to skip events we
+        # already have.
+        # We only compare the fields that identify an event, since events
+        # stored by older versions of this script might have extra fields.
+        def get_event_key(event):
+            return (event['timestamp'], event['action'], event['sponsorable']['login'])
+        known_event_keys = {get_event_key(event)
+            for event in events if event['timestamp'] >= last_timestamp}
+        new_events = [event for event in new_events
+            if get_event_key(event) not in known_event_keys]
+
+    # NOTE: `reconstruct_payments()` processes events on the same day in the
+    # order they come in, so we need to keep them in the newest-first order
+    # GitHub gives us, as if we'd fetched them all in one go. The new events
+    # are all newer than the stored ones, so they go first, and we rewrite the
+    # whole store in that order.
+    events = new_events + events
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f'{events_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for event in events:
+            f.write(orjson.dumps(event, option=orjson.OPT_APPEND_NEWLINE))
+    os.replace(tmp_path, events_path)
+
+    if len(events) > 0:
+        save_cached(last_timestamp_path,
+            max(event['timestamp'] for event in events))
 
     return events
 
 
 """
-Groups events into a dict by the YYYY-MM-DD of their timestamp.
+Converts events as returned by GitHub into flat tuples of `(action, login,
+monthly_price_in_cents, is_one_time, day)`, so that we only need to look into
+each event's nested dicts once. `monthly_price_in_cents` and `is_one_time` are
+`None` if the event has no tier. `day` is the YYYY-MM-DD of the event's
+timestamp.
+"""
+def normalize_events(events):
+    normalized_events = []
+    for event in events:
+        tier = event['sponsorsTier']
+        if tier is None:
+            monthly_price_in_cents, is_one_time = None, None
+        else:
+            monthly_price_in_cents, is_one_time = tier['monthlyPriceInCents'], tier['isOneTime']
+        normalized_events.append((
+            sys.intern(event['action']),
+            sys.intern(event['sponsorable']['login']),
+            monthly_price_in_cents,
+            is_one_time,
+            # NOTE: GitHub's timestamps are always UTC and formatted like
+            # `2024-03-14T12:34:56Z`, so the day is just the first 10
+            # characters.
+            event['timestamp'][:10],
+        ))
+    return normalized_events
+
+
+"""
+Groups normalized events into a dict by their YYYY-MM-DD day. Each day maps to
+a pair of lists: one with the events that need to be processed before that
+day's payments, and one with the new sponsorships that need to be processed
+after them.
 """
 def make_day_to_events_map(events):
-    day_to_events_map = defaultdict(list)
+    day_to_events_map = defaultdict(lambda: ([], []))
     for event in events:
-        timestamp = arrow.get(event['timestamp'])
-        formatted_day = timestamp.format('YYYY-MM-DD')
-        day_to_events_map[formatted_day].append(event)
+        day_to_events_map[event[4]][event[0] == 'NEW_SPONSORSHIP'].append(event)
     return day_to_events_map
 
 
+"""
+Gets the first date after `after_date` that falls on day `monthday` of its
+month. Months that are too short to have that day are skipped.
+"""
+def get_next_monthday_date(after_date, monthday):
+    year, month = after_date.year, after_date.month
+    if after_date.day >= monthday:
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    while monthday > calendar.monthrange(year, month)[1]:
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return date(year, month, monthday)
+
+
 """
 Given a list of events, reconstructs what payments to sponsorables the target
 user _would have_ made, based on a reconstructed version of GitHub's payment
@@ -163,7 +323,7 @@ def reconstruct_payments(events, start_date, end_date):
     payments = []
     payment_monthday = None
     payment_login_to_amount_map = {}
-    day_to_events_map = make_day_to_events_map(events)
+    day_to_events_map = make_day_to_events_map(normalize_events(events))
 
     def remove_sponsorship(login):
         nonlocal payment_monthday
@@ -173,57 +333,85 @@ def reconstruct_payments(events, start_date, end_date):
         if len(payment_login_to_amount_map) == 0:
             payment_monthday = None
 
-    curr_date = start_date
-    while curr_date <= end_date:
-        formatted_day = curr_date.format('YYYY-MM-DD')
+    def handle_cancelled_sponsorship(login, monthly_price_in_cents, is_one_time, day):
+        remove_sponsorship(login)
+
+    def handle_tier_change(login, monthly_price_in_cents, is_one_time, day):
+        if is_one_time:
+            # NOTE: Here, we're assuming that a tier change _into_ a one-time
+            # tier is effectively a payment followed by a cancellation of the
+            # sponsorship.
+            remove_sponsorship(login)
+            payments.append(Payment(
+                date=day,
+                login=login,
+                amount_in_cents=monthly_price_in_cents,
+            ))
+        else:
+            # NOTE: Here, we're assuming that, on tier change, the next payment
+            # will be taken on the usual date, _not_ on the date of the tier
+            # change. We're assuming that nothing but the _amount_ changes on
+            # tier change.
+            payment_login_to_amount_map[login] = monthly_price_in_cents
+
+    def handle_refund(login, monthly_price_in_cents, is_one_time, day):
+        # NOTE: This isn't tested because the exact behaviour is undocumented
+        # by GitHub, but we're assuming that the refund amount is a positive
+        # amount in `monthly_price_in_cents`.
+        payments.append(Payment(
+            date=day,
+            login=login,
+            amount_in_cents=(0 - monthly_price_in_cents),
+        ))
+
+    # These are the events we process before each day's payments. New
+    # sponsorships are processed after them, separately. We ignore any other
+    # events, and `get_sponsorship_log()` doesn't ask GitHub for them, in
+    # particular:
+    # * `PENDING_CHANGE`: we don't need to do anything here because we can
+    #   process the scheduled event when it actually occurs.
+    # * `SPONSOR_MATCH_DISABLED`: we're ignoring this because I haven't found
+    #   any information on what sponsor matching means or how it is used.
+    #   Could be the “GitHub Sponsors Matching Fund”, which doesn't exist
+    #   anymore.
+    event_handlers = {
+        'CANCELLED_SPONSORSHIP': handle_cancelled_sponsorship,
+        'TIER_CHANGE': handle_tier_change,
+        'REFUND': handle_refund,
+    }
+
+    # NOTE: Nothing happens on a day unless it has events or it's the day of
+    # the month we're being billed on, so we jump straight from one such day to
+    # the next instead of walking through every single day.
+    first_date = start_date.date()
+    last_date = end_date.date()
+    event_dates = sorted(date.fromisoformat(day) for day in day_to_events_map)
+    event_dates = [d for d in event_dates if first_date <= d <= last_date]
+    next_event_idx = 0
+    prev_date = None
+    while True:
+        candidate_dates = []
+        if next_event_idx < len(event_dates):
+            candidate_dates.append(event_dates[next_event_idx])
+        if payment_monthday is not None:
+            candidate_dates.append(get_next_monthday_date(prev_date, payment_monthday))
+        if len(candidate_dates) == 0:
+            break
+        curr_date = min(candidate_dates)
+        if curr_date > last_date:
+            break
+        if next_event_idx < len(event_dates) and event_dates[next_event_idx] == curr_date:
+            next_event_idx += 1
+        prev_date = curr_date
+
+        formatted_day = f'{curr_date.year:04d}-{curr_date.month:02d}-{curr_date.day:02d}'
         monthday = curr_date.day
-        todays_events = day_to_events_map[formatted_day]
-
-        for event in todays_events:
-            login = event['sponsorable']['login']
-            match event['action']:
-                case 'PENDING_CHANGE':
-                    # We don't need to do anything here because we can process
-                    # the scheduled event when it actually occurs.
-                    pass
-                case 'SPONSOR_MATCH_DISABLED':
-                    # We're ignoring this because I haven't found any
-                    # information on what sponsor matching means or how it is
-                    # used. Could be the “GitHub Sponsors Matching Fund”, which
-                    # doesn't exist anymore.
-                    pass
-                case 'CANCELLED_SPONSORSHIP':
-                    remove_sponsorship(login)
-                case 'TIER_CHANGE':
-                    monthly_price_in_cents = event['sponsorsTier']['monthlyPriceInCents']
-                    is_one_time = event['sponsorsTier']['isOneTime']
-                    if is_one_time:
-                        # NOTE: Here, we're assuming that a tier change _into_
-                        # a one-time tier is effectively a payment followed by
-                        # a cancellation of the sponsorship.
-                        remove_sponsorship(login)
-                        payments.append(Payment(
-                            date=formatted_day,
-                            login=login,
-                            amount_in_cents=monthly_price_in_cents,
-                        ))
-                    else:
-                        # NOTE: Here, we're assuming that, on tier change, the
-                        # next payment will be taken on the usual date, _not_
-                        # on the date of the tier change. We're assuming that
-                        # nothing but the _amount_ changes on tier change.
-                        payment_login_to_amount_map[login] = monthly_price_in_cents
-                case 'REFUND':
-                    # NOTE: This isn't tested because the exact behaviour is
-                    # undocumented by GitHub, but we're assuming that the
-                    # refund amount is a positive amount in
-                    # `monthly_price_in_cents`.
-                    monthly_price_in_cents = event['sponsorsTier']['monthlyPriceInCents']
-                    payments.append(Payment(
-                        date=formatted_day,
-                        login=login,
-                        amount_in_cents=(0 - monthly_price_in_cents),
-                    ))
+        todays_events, todays_new_sponsorships = day_to_events_map[formatted_day]
+
+        for action, login, monthly_price_in_cents, is_one_time, day in todays_events:
+            handler = event_handlers.get(action)
+            if handler is not None:
+                handler(login, monthly_price_in_cents, is_one_time, day)
 
         if monthday == payment_monthday:
             for login, monthly_price_in_cents in payment_login_to_amount_map.items():
@@ -233,41 +421,58 @@ def reconstruct_payments(events, start_date, end_date):
                     amount_in_cents=monthly_price_in_cents,
                 ))
 
-        for event in todays_events:
-            login = event['sponsorable']['login']
-            match event['action']:
-                case 'NEW_SPONSORSHIP':
-                    # TODO: Why might an error arise here?
-                    try:
-                        monthly_price_in_cents = event['sponsorsTier']['monthlyPriceInCents']
-                        is_one_time = event['sponsorsTier']['isOneTime']
-                    except TypeError:
-                        continue
-                    payments.append(Payment(
-                        date=formatted_day,
-                        login=login,
-                        amount_in_cents=monthly_price_in_cents,
-                    ))
-                    if not is_one_time:
-                        if payment_monthday is None:
-                            payment_monthday = monthday
-                        payment_login_to_amount_map[login] = monthly_price_in_cents
-
-        curr_date = curr_date.shift(days=+1)
+        for _, login, monthly_price_in_cents, is_one_time, _ in todays_new_sponsorships:
+            # TODO: Why might a new sponsorship have no tier?
+            if monthly_price_in_cents is None:
+                continue
+            payments.append(Payment(
+                date=formatted_day,
+                login=login,
+                amount_in_cents=monthly_price_in_cents,
+            ))
+            if not is_one_time:
+                if payment_monthday is None:
+                    payment_monthday = monthday
+                payment_login_to_amount_map[login] = monthly_price_in_cents
 
     return payments
 
 
+"""
+Gets the total amount in US cents of the given `payments`, grouped by month, as
+a list of `(YYYY-MM, amount_in_cents)` pairs.
+"""
+def get_monthly_payment_amounts(payments):
+    # NOTE: We used to ask GitHub for these using
+    # `totalSponsorshipAmountAsSponsorInCents`, but that's broken (see the
+    # README), and the payments we reconstruct already contain everything we
+    # need without making any more requests.
+    month_totals = Counter()
+    for payment in payments:
+        month_totals[payment.date[:7]] += payment.amount_in_cents
+    return sorted(month_totals.items())
+
+
 """
 Print a list of payments as a CSV file.
 """
 def print_payments_csv(payments):
-    print('Date,Sponsorable,Amount in US Cents')
-    for payment in payments:
-        print(f'{payment.date},{payment.login},{payment.amount_in_cents}')
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(('Date', 'Sponsorable', 'Amount in US Cents'))
+    writer.writerows((payment.date, payment.login, payment.amount_in_cents)
+        for payment in payments)
+
+
+"""
+Print a list of `(YYYY-MM, amount_in_cents)` monthly totals as a CSV file.
+"""
+def print_monthly_amounts_csv(monthly_amounts):
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(('Month', 'Amount in US Cents'))
+    writer.writerows(monthly_amounts)
 
 
-def main():
+async def main():
     parser = argparse.ArgumentParser("osp-github-reporter")
     parser.add_argument("--target",
         help="The user or organization to get the report for",
@@ -277,6 +482,13 @@ def main():
         help="Your GitHub personal access token (classic)",
         type=str,
         required=True)
+    parser.add_argument("--cache-ttl",
+        help="How many seconds to reuse cached GitHub responses for",
+        type=int,
+        default=60)
+    parser.add_argument("--monthly",
+        help="Print the total amount paid in each month instead of each payment",
+        action="store_true")
     args = parser.parse_args()
 
     client = get_gql_client(args.token)
@@ -284,10 +496,15 @@ def main():
     START_DATE = arrow.get('2021-08')
     END_DATE = arrow.get()
 
-    events = get_sponsorship_log(client, args.target, START_DATE)
+    async with client as session:
+        events = await get_updated_sponsorship_log(session, args.target,
+            START_DATE, args.cache_ttl)
     payments = reconstruct_payments(events, START_DATE, END_DATE)
-    print_payments_csv(payments)
+    if args.monthly:
+        print_monthly_amounts_csv(get_monthly_payment_amounts(payments))
+    else:
+        print_payments_csv(payments)
 
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())